@@ -1,31 +1,300 @@
 import os
-import base64
+import asyncio
+import hashlib
+import io
 import json
-from PIL import Image, ImageDraw, ImageFont
+import re
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 import anthropic
-from typing import List, Dict, Union
-import glob
+import cv2
+import diskcache
+import numpy as np
+try:
+    # SIMD-accelerated drop-in replacement for the stdlib module
+    import pybase64 as base64
+except ImportError:
+    import base64
+from typing import List, Dict, Optional, Union
 import sys
 from dotenv import load_dotenv
-import random
 import colorsys
+import zlib
 
 # Load environment variables from .env file
 load_dotenv()
 
+# File extensions picked up when a directory is given
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+
+# Claude model used for detection
+MODEL = "claude-3-5-sonnet-20241022"
+
+# Retries per Claude request on transient API errors
+MAX_RETRIES = 5
+
+# Longest side sent to Claude; its vision encoder downsamples beyond this
+MAX_UPLOAD_SIDE = 1568
+
+# JPEG quality of the downscaled upload preview
+UPLOAD_JPEG_QUALITY = 90
+
+# JPEGs with a longer side than this are decoded at half scale for the upload
+# preview, which still leaves at least MAX_UPLOAD_SIDE pixels
+DRAFT_THRESHOLD = 2 * MAX_UPLOAD_SIDE
+
+# Maximum number of Claude requests in flight at once
+MAX_CONCURRENT_REQUESTS = 10
+
+# Shared by every request so the prompt is byte-identical and cacheable
+SYSTEM_PROMPT = """
+You are a precise UI element detection system specialized in identifying EVERY visual component in user interfaces.
+
+YOUR TASK:
+Detect and locate every single visual element in the UI with pixel-perfect accuracy.
+
+OUTPUT FORMAT:
+Call the record_ui_elements tool once with every element:
+{
+    "elements": [
+        {
+            "element": "specific-element-type",
+            "label": "exact-content-or-purpose",
+            "bbox": [x1, y1, x2, y2],
+            "confidence": confidence_score
+        }
+    ]
+}
+
+BOUNDING BOX GUIDELINES:
+1. Tight Boundaries:
+   - Boxes should tightly wrap around elements
+   - Include padding/margins only if they're part of the element
+   - For text, capture the exact text bounds
+   - For buttons, include the full clickable area
+   - For icons, include only the icon artwork
+
+2. Nested Elements:
+   - Detect both containers and their contents
+   - Menu items within dropdowns
+   - Text within buttons
+   - Icons within buttons
+   - Labels within form fields
+
+3. Common UI Patterns:
+   - Navigation bars: [0.0, 0.0, 1.0, 0.08] (full width, top)
+   - Sidebars: [0.0, 0.0, 0.25, 1.0] (full height, left side)
+   - Modal dialogs: centered, with padding
+   - Buttons: include full padding and borders
+   - Text fields: include borders and internal padding
+
+4. Precision Requirements:
+   - Use 4 decimal places for coordinates
+   - Ensure x2 > x1 and y2 > y1
+   - Coordinates must be normalized (0-1)
+   - No overlapping boxes unless elements truly overlap
+   - No gaps between adjacent elements
+
+ELEMENT HIERARCHY:
+1. Page Structure:
+   - header
+   - main-content
+   - sidebar
+   - footer
+
+2. Navigation:
+   - nav-bar
+   - nav-item
+   - nav-dropdown
+   - breadcrumb
+
+3. Content:
+   - heading-1 (main title)
+   - heading-2 (section titles)
+   - heading-3 (subsections)
+   - paragraph-text
+   - list-item
+   - table-cell
+
+4. Interactive:
+   - button-primary (main actions)
+   - button-secondary (optional actions)
+   - input-field (form inputs)
+   - checkbox
+   - radio-button
+   - dropdown-select
+
+5. Media:
+   - icon (interface icons)
+   - image (content images)
+   - avatar (user images)
+   - logo (brand images)
+
+6. Status/Feedback:
+   - alert-message
+   - progress-bar
+   - loading-spinner
+   - tooltip
+   - badge
+
+CRITICAL RULES:
+1. PRECISION - Coordinates must perfectly match visual boundaries
+2. COMPLETENESS - Detect every element, no matter how small
+3. HIERARCHY - Maintain proper nesting of elements
+4. NO OVERLAP - Unless elements truly overlap in UI
+5. NO GAPS - Adjacent elements should touch exactly
+6. CONSISTENCY - Similar elements should have similar sizes
+7. OUTPUT - Report elements only through the record_ui_elements tool, no explanations
+
+Remember: Your coordinate accuracy directly affects the usability of the UI analysis.
+"""
+
+# Tool Claude is forced to call, so results arrive as structured input
+# instead of JSON embedded in free text
+UI_ELEMENTS_TOOL = {
+    "name": "record_ui_elements",
+    "description": "Record every UI element detected in the image with its bounding box.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "elements": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "element": {"type": "string"},
+                        "label": {"type": "string"},
+                        "bbox": {
+                            "type": "array",
+                            "items": {"type": "number"},
+                            "minItems": 4,
+                            "maxItems": 4
+                        },
+                        "confidence": {"type": "number"}
+                    },
+                    "required": ["element", "bbox"]
+                }
+            }
+        },
+        "required": ["elements"]
+    }
+}
+
+# Label font; falls back to Pillow's default font when unavailable
+FONT_PATH = "/System/Library/Fonts/Helvetica.ttc"
+
+# Number of fallback colors for element types missing from COLOR_MAP
+PALETTE_SIZE = 32
+
+# Box colors by base element type, matched as a substring of the element name
+COLOR_MAP = {
+    'text': '#FF4444',     # Red for text
+    'button': '#44FF44',   # Green for buttons
+    'input': '#4444FF',    # Blue for inputs
+    'icon': '#FFFF44',     # Yellow for icons
+    'container': '#FF44FF', # Purple for containers
+    'nav': '#44FFFF',      # Cyan for navigation
+    'image': '#FF8844',    # Orange for images
+    'status': '#88FF44',   # Lime for status elements
+    'modal': '#FF4488',    # Pink for modals
+    'list': '#4488FF',     # Light blue for lists
+}
+
+# Part of the response cache key: changing the model, prompt, tool schema or
+# upload preprocessing invalidates old results
+REQUEST_HASH = hashlib.sha256(json.dumps({
+    "model": MODEL,
+    "system_prompt": SYSTEM_PROMPT,
+    "tool": UI_ELEMENTS_TOOL,
+    "max_upload_side": MAX_UPLOAD_SIDE,
+    "upload_jpeg_quality": UPLOAD_JPEG_QUALITY,
+}, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _clamp(value: float, upper: float) -> float:
+    """Clamp value to [0, upper] without nested min/max calls.
+
+    Like min(max(0, value), upper), a negative ``upper`` (a label wider than
+    the image) wins over the lower bound and is returned as is.
+    """
+    return 0.0 if value < 0 else (upper if value > upper else value)
+
 class UIVisionProcessor:
-    def __init__(self):
-        """Initialize the processor with your Anthropic API key from .env."""
-        self.client = anthropic.Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
+    def __init__(self, output_format: str = 'jpeg', refresh_cache: bool = False):
+        """Initialize the processor with your Anthropic API key from .env.
+
+        ``output_format`` is 'jpeg' (default) or 'png' for annotated images;
+        PNG output keeps the source image's transparency. With
+        ``refresh_cache`` every image is sent to Claude and the cached
+        result is overwritten.
+        """
+        if output_format not in ('jpeg', 'png'):
+            raise ValueError(f"Unsupported output format: {output_format}")
+        self.output_format = output_format
+        self.refresh_cache = refresh_cache
+        # The SDK retries rate limits (429), overload (529), 5xx and connection
+        # errors with exponential backoff, honoring retry-after headers
+        self.client = anthropic.AsyncAnthropic(api_key=os.getenv('ANTHROPIC_API_KEY'),
+                                               max_retries=MAX_RETRIES)
         self.output_dir = os.path.join(os.getcwd(), 'output')
         os.makedirs(self.output_dir, exist_ok=True)
-
-    def encode_image(self, image_path: str) -> tuple[str, str]:
-        """Encode an image file to base64 and determine its media type."""
+        self.cache = diskcache.Cache(os.path.join(self.output_dir, '.llm_cache'))
+        # Images lazily opened from the bytes read for upload, reused when
+        # drawing to avoid reading the file again. Only the encoded bytes are
+        # held until draw time; pixels are decoded one image at a time on draw.
+        self._images: Dict[str, Image.Image] = {}
+        # Match element types to base types in one scan, with colors pre-parsed
+        self._type_re = re.compile('|'.join(map(re.escape, COLOR_MAP)))
+        self._color_map_rgb = {k: ImageColor.getrgb(v) for k, v in COLOR_MAP.items()}
+        self._palette = self.build_palette()
+        self._font_cache = {}
+        # Image paths of the latest run, in result-number order
+        self.last_image_paths: List[str] = []
+
+    def open_preview(self, fp) -> Image.Image:
+        """Open an image for the upload preview, decoding large JPEGs at reduced scale."""
+        image = Image.open(fp)
+        if image.format == 'JPEG' and max(image.size) > DRAFT_THRESHOLD:
+            # Let libjpeg skip an IDCT level by decoding at half scale
+            image.draft('RGB', (image.width // 2, image.height // 2))
+        return image
+
+    def read_image(self, image_path: str) -> tuple[bytes, str]:
+        """Read an image file and return its bytes and SHA-256 hash."""
         with open(image_path, 'rb') as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-
-        ext = image_path.lower().split('.')[-1]
+            raw = image_file.read()
+        return raw, hashlib.sha256(raw).hexdigest()
+
+    def _read_cached(self, image_path: str) -> tuple[bytes, str, Optional[List[Dict]]]:
+        """Read an image and look up its cached result, returning bytes, cache key and result."""
+        raw, image_hash = self.read_image(image_path)
+        cache_key = f"{image_hash}:{REQUEST_HASH}"
+        cached = None if self.refresh_cache else self.cache.get(cache_key)
+        return raw, cache_key, cached
+
+    def encode_image(self, image_path: str, raw: bytes) -> tuple[str, str, Image.Image]:
+        """Encode an image's bytes to base64 and determine its media type.
+
+        Images larger than MAX_UPLOAD_SIDE are downscaled and re-encoded as JPEG
+        before upload. Also returns the full-size image opened (not decoded)
+        from the same bytes so it can be drawn on without reading the file again.
+        """
+        image = Image.open(io.BytesIO(raw))
+
+        if max(image.size) > MAX_UPLOAD_SIDE:
+            # Claude downsamples large images anyway; send fewer bytes.
+            # Boxes are normalized, so they still apply to the original.
+            # The preview is its own image so the one kept for drawing stays
+            # undecoded until it is drawn.
+            preview = self.open_preview(io.BytesIO(raw))
+            preview.thumbnail((MAX_UPLOAD_SIDE, MAX_UPLOAD_SIDE), Image.LANCZOS)
+            buffer = io.BytesIO()
+            preview.convert('RGB').save(buffer, 'JPEG', quality=UPLOAD_JPEG_QUALITY)
+            encoded_string = base64.b64encode(buffer.getvalue()).decode('ascii')
+            return encoded_string, 'image/jpeg', image
+
+        encoded_string = base64.b64encode(raw).decode('ascii')
+
+        ext = os.path.splitext(image_path)[1][1:].lower()
         media_types = {
             'jpg': 'image/jpeg',
             'jpeg': 'image/jpeg',
@@ -35,245 +304,222 @@ class UIVisionProcessor:
         }
         media_type = media_types.get(ext, 'image/jpeg')
 
-        return encoded_string, media_type
-
-    def process_images(self, image_paths: Union[str, List[str]]) -> Dict:
-        """Process images to detect UI elements and their bounding boxes."""
-        if isinstance(image_paths, str):
-            if os.path.isdir(image_paths):
-                image_paths = []
-                for ext in ['*.jpg', '*.jpeg', '*.png', '*.gif', '*.webp']:
-                    image_paths.extend(glob.glob(os.path.join(image_paths, ext)))
-                if not image_paths:
-                    raise ValueError(f"No supported images found in directory {image_paths}")
-            else:
-                if not os.path.exists(image_paths):
-                    raise ValueError(f"Image path does not exist: {image_paths}")
-                image_paths = [image_paths]
-
-        print(f"Processing {len(image_paths)} images...")
-
-        content = []
-        for idx, img_path in enumerate(image_paths, 1):
-            print(f"Processing image {idx}: {img_path}")
-            content.append({
-                "type": "text",
-                "text": f"Image {idx}:"
-            })
-
-            try:
-                # Directly encode the original image
-                encoded_image, media_type = self.encode_image(img_path)
-                content.append({
+        return encoded_string, media_type, image
+
+    async def _analyze_image(self, semaphore: asyncio.Semaphore, idx: int, img_path: str) -> List[Dict]:
+        """Send a single image to Claude and return its list of bounding boxes."""
+        # File, cache and image work runs under the semaphore in worker threads,
+        # so payloads are only built for requests about to be sent and the
+        # event loop keeps serving the requests already in flight
+        async with semaphore:
+            raw, cache_key, cached = await asyncio.to_thread(self._read_cached, img_path)
+            if cached is not None:
+                # Only open the image for drawing; skip building the upload payload
+                self._images[img_path] = await asyncio.to_thread(Image.open, io.BytesIO(raw))
+                print(f"Using cached result for image {idx}: {img_path}")
+                return cached
+
+            encoded_image, media_type, image = await asyncio.to_thread(self.encode_image, img_path, raw)
+            self._images[img_path] = image
+
+            content = [
+                {
+                    "type": "text",
+                    "text": f"Image {idx}:"
+                },
+                {
                     "type": "image",
                     "source": {
                         "type": "base64",
                         "media_type": media_type,
                         "data": encoded_image
                     }
-                })
-            except Exception as e:
-                print(f"Error processing image {img_path}: {str(e)}")
-                continue
-
-        system_prompt = """
-        You are a precise UI element detection system specialized in identifying EVERY visual component in user interfaces. 
-
-        YOUR TASK:
-        Detect and locate every single visual element in the UI with pixel-perfect accuracy.
-
-        OUTPUT FORMAT:
-        {
-            "image_number": [
-                {
-                    "element": "specific-element-type",
-                    "label": "exact-content-or-purpose",
-                    "bbox": [x1, y1, x2, y2],
-                    "confidence": confidence_score
                 }
             ]
-        }
-
-        BOUNDING BOX GUIDELINES:
-        1. Tight Boundaries:
-           - Boxes should tightly wrap around elements
-           - Include padding/margins only if they're part of the element
-           - For text, capture the exact text bounds
-           - For buttons, include the full clickable area
-           - For icons, include only the icon artwork
-
-        2. Nested Elements:
-           - Detect both containers and their contents
-           - Menu items within dropdowns
-           - Text within buttons
-           - Icons within buttons
-           - Labels within form fields
-
-        3. Common UI Patterns:
-           - Navigation bars: [0.0, 0.0, 1.0, 0.08] (full width, top)
-           - Sidebars: [0.0, 0.0, 0.25, 1.0] (full height, left side)
-           - Modal dialogs: centered, with padding
-           - Buttons: include full padding and borders
-           - Text fields: include borders and internal padding
-
-        4. Precision Requirements:
-           - Use 4 decimal places for coordinates
-           - Ensure x2 > x1 and y2 > y1
-           - Coordinates must be normalized (0-1)
-           - No overlapping boxes unless elements truly overlap
-           - No gaps between adjacent elements
-
-        ELEMENT HIERARCHY:
-        1. Page Structure:
-           - header
-           - main-content
-           - sidebar
-           - footer
-
-        2. Navigation:
-           - nav-bar
-           - nav-item
-           - nav-dropdown
-           - breadcrumb
-
-        3. Content:
-           - heading-1 (main title)
-           - heading-2 (section titles)
-           - heading-3 (subsections)
-           - paragraph-text
-           - list-item
-           - table-cell
-
-        4. Interactive:
-           - button-primary (main actions)
-           - button-secondary (optional actions)
-           - input-field (form inputs)
-           - checkbox
-           - radio-button
-           - dropdown-select
-
-        5. Media:
-           - icon (interface icons)
-           - image (content images)
-           - avatar (user images)
-           - logo (brand images)
-
-        6. Status/Feedback:
-           - alert-message
-           - progress-bar
-           - loading-spinner
-           - tooltip
-           - badge
-
-        CRITICAL RULES:
-        1. PRECISION - Coordinates must perfectly match visual boundaries
-        2. COMPLETENESS - Detect every element, no matter how small
-        3. HIERARCHY - Maintain proper nesting of elements
-        4. NO OVERLAP - Unless elements truly overlap in UI
-        5. NO GAPS - Adjacent elements should touch exactly
-        6. CONSISTENCY - Similar elements should have similar sizes
-        7. OUTPUT - Return only valid JSON, no explanations
-
-        Remember: Your coordinate accuracy directly affects the usability of the UI analysis.
-        """
 
-        try:
-            print("Analyzing images with Claude...")
-            response = self.client.messages.create(
-                model="claude-3-5-sonnet-20241022",
+            print(f"Analyzing image {idx} with Claude: {img_path}")
+            response = await self.client.messages.create(
+                model=MODEL,
                 max_tokens=8000,
-                system=system_prompt,
+                # Mark the shared system prompt as cacheable so concurrent and
+                # repeated requests reuse it instead of re-processing it
+                system=[{
+                    "type": "text",
+                    "text": SYSTEM_PROMPT,
+                    "cache_control": {"type": "ephemeral"}
+                }],
+                tools=[UI_ELEMENTS_TOOL],
+                tool_choice={"type": "tool", "name": UI_ELEMENTS_TOOL["name"]},
                 messages=[{
                     "role": "user",
                     "content": content
                 }]
             )
 
-            response_text = response.content[0].text
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}') + 1
+        # A reply cut off at max_tokens carries incomplete tool input; fail the
+        # image rather than caching a partial element list
+        if response.stop_reason == "max_tokens":
+            raise ValueError("Response was truncated at max_tokens")
+
+        tool_use = next((block for block in response.content
+                         if block.type == "tool_use" and block.name == UI_ELEMENTS_TOOL["name"]), None)
+        if tool_use is None or "elements" not in tool_use.input:
+            raise ValueError("No UI elements returned in response")
+        result = tool_use.input["elements"]
 
-            if json_start >= 0 and json_end > json_start:
-                bboxes = json.loads(response_text[json_start:json_end])
-                print("Successfully extracted bounding boxes")
-                return bboxes
+        await asyncio.to_thread(self.cache.set, cache_key, result)
+        return result
+
+    async def process_images_async(self, image_paths: Union[str, List[str]]) -> Dict:
+        """Process images concurrently, one Claude request per image."""
+        if isinstance(image_paths, str):
+            if os.path.isdir(image_paths):
+                directory = image_paths
+                image_paths = sorted(
+                    entry.path for entry in os.scandir(directory)
+                    if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+                )
+                if not image_paths:
+                    raise ValueError(f"No supported images found in directory {directory}")
             else:
-                raise ValueError("No valid JSON found in response")
+                if not os.path.exists(image_paths):
+                    raise ValueError(f"Image path does not exist: {image_paths}")
+                image_paths = [image_paths]
 
-        except Exception as e:
-            print(f"Error processing images: {str(e)}")
+        self.last_image_paths = image_paths
+        print(f"Processing {len(image_paths)} images...")
+
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        responses = await asyncio.gather(
+            *[self._analyze_image(semaphore, idx, img_path)
+              for idx, img_path in enumerate(image_paths, 1)],
+            return_exceptions=True
+        )
+
+        bboxes = {}
+        for idx, (img_path, response) in enumerate(zip(image_paths, responses), 1):
+            if isinstance(response, Exception):
+                print(f"Error processing image {img_path}: {str(response)}")
+                # Failed images are never drawn, so release the kept copy now
+                self._images.pop(img_path, None)
+                continue
+            bboxes[str(idx)] = response
+
+        if not bboxes:
             return None
 
-    def get_random_color(self):
-        """Generate a random vibrant color using HSV color space."""
-        # Use golden ratio to generate well-distributed hues
+        print(f"Successfully extracted bounding boxes for {len(bboxes)} images")
+        return bboxes
+
+    def process_images(self, image_paths: Union[str, List[str]]) -> Dict:
+        """Process images to detect UI elements and their bounding boxes."""
+        return asyncio.run(self.process_images_async(image_paths))
+
+    def build_palette(self, size: int = PALETTE_SIZE) -> List[tuple]:
+        """Generate a fixed palette of vibrant RGB colors using HSV color space."""
+        # Use golden ratio steps to generate well-distributed hues
         golden_ratio = 0.618033988749895
-        hue = random.random()
-        hue = (hue + golden_ratio) % 1.0
-        
-        # Use high saturation and value for vibrant colors
-        saturation = 0.85 + random.random() * 0.15  # 0.85-1.00
-        value = 0.85 + random.random() * 0.15       # 0.85-1.00
-        
-        # Convert HSV to RGB
-        rgb = colorsys.hsv_to_rgb(hue, saturation, value)
-        
-        # Convert to hex color string
-        return '#{:02x}{:02x}{:02x}'.format(
-            int(rgb[0] * 255),
-            int(rgb[1] * 255),
-            int(rgb[2] * 255)
-        )
+        palette = []
+        for i in range(size):
+            rgb = colorsys.hsv_to_rgb((i * golden_ratio) % 1.0, 0.9, 0.95)
+            palette.append(tuple(int(c * 255) for c in rgb))
+        return palette
+
+    def get_element_color(self, element_type: str) -> tuple:
+        """Pick a stable palette color for an element type without a mapped color."""
+        # crc32 rather than hash() so colors stay the same across runs
+        return self._palette[zlib.crc32(element_type.encode('utf-8')) % len(self._palette)]
+
+    def get_font(self, size: int):
+        """Return the label font at the given size, loading it only once per size."""
+        font = self._font_cache.get(size)
+        if font is None:
+            try:
+                font = ImageFont.truetype(FONT_PATH, size)
+            except:
+                font = ImageFont.load_default()
+            self._font_cache[size] = font
+        return font
 
-    def draw_bounding_boxes(self, image_path: str, bboxes: List[Dict]):
-        """Draw bounding boxes on a UI screenshot and save the result."""
+    def draw_bounding_boxes(self, image_path: str, bboxes: List[Dict],
+                            image: Optional[Image.Image] = None):
+        """Draw bounding boxes on a UI screenshot and save the result.
+
+        Uses ``image`` (or the copy decoded by process_images) when available,
+        falling back to opening ``image_path``.
+        """
         try:
-            # Open original image directly
-            image = Image.open(image_path)
-            draw = ImageDraw.Draw(image)
+            if image is None:
+                image = self._images.pop(image_path, None)
+            if image is None:
+                image = Image.open(image_path)
             width, height = image.size
 
             font_size = int(height * 0.015)  # Scale font to image height
-            try:
-                font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", font_size)
-            except:
-                font = ImageFont.load_default()
+            font = self.get_font(font_size)
 
-            color_map = {
-                'text': '#FF4444',     # Red for text
-                'button': '#44FF44',   # Green for buttons
-                'input': '#4444FF',    # Blue for inputs
-                'icon': '#FFFF44',     # Yellow for icons
-                'container': '#FF44FF', # Purple for containers
-                'nav': '#44FFFF',      # Cyan for navigation
-                'image': '#FF8844',    # Orange for images
-                'status': '#88FF44',   # Lime for status elements
-                'modal': '#FF4488',    # Pink for modals
-                'list': '#4488FF',     # Light blue for lists
-            }
+            # Measure label height once; widths use the C-level advance length
+            if hasattr(font, 'getmetrics'):
+                ascent, descent = font.getmetrics()
+                text_height = ascent + descent
+            else:
+                text_height = font.getbbox("Ag")[3]
+            if hasattr(font, 'getlength'):
+                measure_text = font.getlength
+            else:
+                measure_text = lambda text: font.getbbox(text)[2]
 
+            # Convert normalized coordinates to pixel coordinates for all boxes at once
+            valid = []
             for bbox in bboxes:
+                coords = bbox.get('bbox') if isinstance(bbox, dict) else None
+                if (isinstance(coords, (list, tuple)) and len(coords) == 4
+                        and all(isinstance(c, (int, float)) for c in coords)):
+                    valid.append(bbox)
+                else:
+                    print(f"Warning: Skipping invalid bounding box: {bbox}")
+
+            coords = np.array([bbox['bbox'] for bbox in valid], dtype=np.float64).reshape(-1, 4)
+            xs = np.sort(coords[:, [0, 2]] * width, axis=1)
+            ys = np.sort(coords[:, [1, 3]] * height, axis=1)
+
+            # Validate coordinates
+            np.clip(xs, 0, width, out=xs)
+            np.clip(ys, 0, height, out=ys)
+            keep = (xs[:, 1] - xs[:, 0] >= 2) & (ys[:, 1] - ys[:, 0] >= 2)
+
+            # PNG output keeps the source's transparency; everything else is RGB
+            keep_alpha = (self.output_format == 'png'
+                          and ('A' in image.getbands() or 'transparency' in image.info))
+
+            # Draw every box in one OpenCV pass over an RGB(A) array
+            pixels = np.array(image.convert('RGBA' if keep_alpha else 'RGB'))
+            labeled = []
+            for i in np.flatnonzero(keep):
+                bbox = valid[i]
+                x1, x2 = xs[i].tolist()
+                y1, y2 = ys[i].tolist()
                 try:
                     element_type = bbox.get('element', 'unknown').lower()
-                    base_type = next((k for k in color_map.keys() if k in element_type), 'unknown')
-                    color = color_map.get(base_type, self.get_random_color())
-
-                    # Convert normalized coordinates to pixel coordinates
-                    x1, y1, x2, y2 = bbox['bbox']
-                    x1, x2 = sorted([x1 * width, x2 * width])
-                    y1, y2 = sorted([y1 * height, y2 * height])
+                    match = self._type_re.search(element_type)
+                    if match:
+                        color = self._color_map_rgb[match.group(0)]
+                    else:
+                        color = self.get_element_color(element_type)
 
-                    # Validate coordinates
-                    x1 = max(0, min(x1, width))
-                    x2 = max(0, min(x2, width))
-                    y1 = max(0, min(y1, height))
-                    y2 = max(0, min(y2, height))
+                    cv2.rectangle(pixels, (int(x1), int(y1)), (int(x2), int(y2)),
+                                  color + (255,) if keep_alpha else color, 2)
+                    labeled.append((bbox, color, x1, y1))
 
-                    if x2 - x1 < 2 or y2 - y1 < 2:
-                        continue
+                except Exception as e:
+                    print(f"Warning: Skipping invalid bounding box: {str(e)}")
+                    continue
 
-                    draw.rectangle([x1, y1, x2, y2], outline=color, width=2)
+            image = Image.fromarray(pixels)
+            draw = ImageDraw.Draw(image)
 
+            for bbox, color, x1, y1 in labeled:
+                try:
                     # Create label
                     label_parts = []
                     if 'element' in bbox:
@@ -287,13 +533,11 @@ class UIVisionProcessor:
 
                     # Draw label with background
                     label_y = max(font_size, y1 - font_size)
-                    text_bbox = draw.textbbox((x1, label_y), label, font=font)
-                    text_width = text_bbox[2] - text_bbox[0]
-                    text_height = text_bbox[3] - text_bbox[1]
+                    text_width = int(measure_text(label))
 
-                    bg_x1 = min(max(0, x1), width - text_width)
+                    bg_x1 = _clamp(x1, width - text_width)
                     bg_x2 = min(bg_x1 + text_width, width)
-                    bg_y1 = min(max(0, label_y), height - text_height)
+                    bg_y1 = _clamp(label_y, height - text_height)
                     bg_y2 = min(bg_y1 + text_height, height)
 
                     draw.rectangle([bg_x1, bg_y1, bg_x2, bg_y2],
@@ -305,9 +549,17 @@ class UIVisionProcessor:
                     continue
 
             # Save output
-            basename = os.path.basename(image_path)
-            output_path = os.path.join(self.output_dir, f'ui_analyzed_{basename}')
-            image.save(output_path)
+            # Fold the source extension into the name so shot.png and shot.jpg
+            # don't collide: ui_analyzed_shot_png.jpg
+            stem, ext = os.path.splitext(os.path.basename(image_path))
+            basename = f'{stem}_{ext[1:]}' if ext else stem
+            if self.output_format == 'png':
+                # Low zlib level: larger files but several times faster to encode
+                output_path = os.path.join(self.output_dir, f'ui_analyzed_{basename}.png')
+                image.save(output_path, 'PNG', optimize=False, compress_level=1)
+            else:
+                output_path = os.path.join(self.output_dir, f'ui_analyzed_{basename}.jpg')
+                image.convert('RGB').save(output_path, 'JPEG', quality=85, optimize=False, progressive=True)
             print(f"Saved annotated UI analysis to: {output_path}")
 
         except Exception as e:
@@ -325,19 +577,19 @@ def main():
         return
 
     try:
-        processor = UIVisionProcessor()
+        processor = UIVisionProcessor(
+            output_format=os.getenv('OUTPUT_FORMAT', 'jpeg').lower(),
+            refresh_cache=os.getenv('REFRESH_CACHE', '').lower() in ('1', 'true', 'yes')
+        )
         result = processor.process_images(input_path)
 
         if result:
-            for image_num, bboxes in result.items():
-                if os.path.isdir(input_path):
-                    images = glob.glob(os.path.join(input_path, f'*{image_num}.*'))
-                    if images:
-                        image_path = images[0]
-                else:
-                    image_path = input_path
+            path_by_num = {str(idx): path for idx, path in enumerate(processor.last_image_paths, 1)}
+            pairs = [(path_by_num[image_num], bboxes) for image_num, bboxes in result.items()]
 
-                processor.draw_bounding_boxes(image_path, bboxes)
+            # Drawing and encoding release the GIL, so annotate images in parallel
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                list(executor.map(lambda pair: processor.draw_bounding_boxes(*pair), pairs))
 
     except Exception as e:
         print(f"Error: {str(e)}")